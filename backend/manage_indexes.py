@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Compare the MongoDB indexes declared in server.INDEX_REGISTRY with the database.
+
+Usage:
+    python manage_indexes.py diff     # missing, changed and undeclared indexes
+    python manage_indexes.py unused   # indexes without accesses since the server started
+    python manage_indexes.py ensure   # create missing indexes
+
+Uses MONGO_URL and DB_NAME like the server. diff and ensure exit with 1 when
+declared indexes are missing or differ, so they can gate a deployment.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+async def show_diff() -> int:
+    report = await server.diff_indexes()
+    drift = False
+    for collection, entries in report.items():
+        for kind in ("missing", "changed", "undeclared"):
+            for name in entries[kind]:
+                print(f"{collection:<22} {kind:<11} {name}")
+                drift = drift or kind != "undeclared"
+    if not drift:
+        print("✅ All declared indexes exist")
+    return 1 if drift else 0
+
+async def show_unused() -> int:
+    report = await server.index_report()
+    for collection, entries in report.items():
+        for name in entries["unused"]:
+            print(f"{collection:<22} unused      {name}")
+    return 0
+
+async def ensure() -> int:
+    result = await server.ensure_indexes()
+    print(json.dumps(result, indent=2))
+    return 1 if result["errors"] else 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Manage the MongoDB indexes declared in server.py")
+    parser.add_argument("command", choices=["diff", "unused", "ensure"], nargs="?", default="diff")
+    args = parser.parse_args()
+    command = {"diff": show_diff, "unused": show_unused, "ensure": ensure}[args.command]
+    return asyncio.run(command())
+
+if __name__ == "__main__":
+    sys.exit(main())
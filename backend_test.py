@@ -725,7 +725,7 @@ class PremiumSubscriptionTester:
             response = requests.get(f"{API_BASE}/messages", headers=headers)
             
             if response.status_code == 200:
-                messages = response.json()
+                messages = response.json()["messages"]
                 
                 # Verify all messages belong to this user (by checking we can delete them)
                 user_message_count = len(messages)
@@ -737,8 +737,8 @@ class PremiumSubscriptionTester:
                 if (scheduled_response.status_code == 200 and 
                     delivered_response.status_code == 200):
                     
-                    scheduled_msgs = scheduled_response.json()
-                    delivered_msgs = delivered_response.json()
+                    scheduled_msgs = scheduled_response.json()["messages"]
+                    delivered_msgs = delivered_response.json()["messages"]
                     
                     # Verify filtering works
                     all_scheduled = all(msg.get('status') == 'scheduled' for msg in scheduled_msgs)
@@ -843,7 +843,7 @@ class PremiumSubscriptionTester:
                 # Check if message has been delivered
                 response = requests.get(f"{API_BASE}/messages", headers=headers)
                 if response.status_code == 200:
-                    messages = response.json()
+                    messages = response.json()["messages"]
                     test_message = next((msg for msg in messages if msg['id'] == message_id), None)
                     
                     if test_message:
@@ -1182,7 +1182,7 @@ class PremiumSubscriptionTester:
                 self.log_result("AI Integration Test", False, "Failed to retrieve messages")
                 return False
             
-            messages = response.json()
+            messages = response.json()["messages"]
             ai_message = next((msg for msg in messages if msg['id'] == message_response['id']), None)
             
             if ai_message and ai_message['content'] == enhanced_text:
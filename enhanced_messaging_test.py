@@ -767,7 +767,7 @@ class EnhancedMessagingTester:
                 self.log_result("Bulk Message Time Intervals", False, "Failed to retrieve messages")
                 return False
             
-            all_messages = response.json()
+            all_messages = response.json()["messages"]
             interval_messages = [msg for msg in all_messages if msg['id'] in created_message_ids]
             
             if len(interval_messages) != 3:
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, createContext, useContext } from "react";
+import React, { useState, useEffect, useRef, createContext, useContext } from "react";
 import { BrowserRouter, Routes, Route, Navigate } from "react-router-dom";
 import { 
   MessageSquare, 
@@ -91,7 +91,8 @@ const AuthProvider = ({ children }) => {
       email, 
       password, 
       name, 
-      referral_code: referralCode 
+      referral_code: referralCode,
+      timezone: Intl.DateTimeFormat().resolvedOptions().timeZone
     });
     const { access_token, user: userData } = response.data;
     localStorage.setItem('token', access_token);
@@ -425,9 +426,31 @@ const Header = ({ activeTab, setActiveTab }) => {
 };
 
 // Main Dashboard Component
+// "Load more" for cursor-paginated lists; hidden once the last page is loaded
+const LoadMoreButton = ({ cursor, loading, onClick }) => {
+  if (!cursor) return null;
+  return (
+    <div className="text-center mt-4">
+      <button
+        onClick={onClick}
+        disabled={loading}
+        className="bg-gray-100 hover:bg-gray-200 text-gray-700 font-medium py-2 px-4 rounded-lg transition-colors disabled:opacity-50"
+      >
+        {loading ? 'Lädt...' : 'Mehr laden'}
+      </button>
+    </div>
+  );
+};
+
 const Dashboard = () => {
   const { t } = useContext(LanguageContext);
-  const [messages, setMessages] = useState([]);
+  // One page-wise loaded list per tab; totals come from the server
+  const [messageTabs, setMessageTabs] = useState({
+    scheduled: { messages: [], total: 0 },
+    delivered: { messages: [], total: 0 }
+  });
+  const messageTabsRef = useRef(messageTabs);  // for the live event handlers, which outlive a render
+  messageTabsRef.current = messageTabs;
   const [activeTab, setActiveTab] = useState('create');
   const [formData, setFormData] = useState({
     title: '',
@@ -499,11 +522,39 @@ const Dashboard = () => {
   const [contactTypeFilter, setContactTypeFilter] = useState('');
   const [deliveryStatusFilter, setDeliveryStatusFilter] = useState('');
 
-  // Fetch messages
+  // Keyset pagination: lists load their first page, further pages on "load more".
+  // Per list we keep the next cursor and the filters it was issued for.
+  const [nextPages, setNextPages] = useState({});
+  const [loadingMore, setLoadingMore] = useState(null);
+
+  const setNextPage = (list, cursor, params = {}) => {
+    setNextPages(prev => ({ ...prev, [list]: cursor ? { cursor, params } : null }));
+  };
+
+  // Append items to a list, skipping ones already shown (e.g. added by a live event)
+  const appendNew = (prev, items) => {
+    const known = new Set(prev.map(item => item.id));
+    return prev.concat(items.filter(item => !known.has(item.id)));
+  };
+
+  // Scheduled messages are listed by scheduled time, the earliest first
+  const sortScheduled = (messages) => [...messages].sort((a, b) =>
+    new Date(a.scheduled_time) - new Date(b.scheduled_time) || a.id.localeCompare(b.id)
+  );
+
+  // Fetch the first page of both message tabs
   const fetchMessages = async () => {
     try {
-      const response = await axios.get(`${API}/messages`);
-      setMessages(response.data);
+      const [scheduledRes, deliveredRes] = await Promise.all([
+        axios.get(`${API}/messages/scheduled`),
+        axios.get(`${API}/messages/delivered`)
+      ]);
+      setMessageTabs({
+        scheduled: { messages: scheduledRes.data.messages, total: scheduledRes.data.total },
+        delivered: { messages: deliveredRes.data.messages, total: deliveredRes.data.total }
+      });
+      setNextPage('scheduled', scheduledRes.data.next_cursor);
+      setNextPage('delivered', deliveredRes.data.next_cursor);
     } catch (error) {
       console.error('Error fetching messages:', error);
     }
@@ -557,6 +608,8 @@ const Dashboard = () => {
         transactions: transactionsRes.data.transactions || [],
         payouts: payoutsRes.data.payouts || []
       });
+      setNextPage('transactions', transactionsRes.data.next_cursor);
+      setNextPage('payouts', payoutsRes.data.next_cursor);
     } catch (error) {
       console.error('Error fetching admin data:', error);
     }
@@ -604,9 +657,6 @@ const Dashboard = () => {
         linkElement.setAttribute('href', dataUri);
         linkElement.setAttribute('download', exportFileDefaultName);
         linkElement.click();
-      } else {
-        // CSV export would be handled by the backend in a real implementation
-        alert('CSV Export vorbereitet. In einer echten Implementierung würde eine CSV-Datei heruntergeladen.');
       }
     } catch (error) {
       console.error('Error exporting analytics:', error);
@@ -614,6 +664,27 @@ const Dashboard = () => {
     }
   };
 
+  // Download a streamed export (csv, ndjson, parquet) of one analytics dataset
+  const downloadAnalyticsExport = async (dataset, format = 'csv') => {
+    if (user?.role !== 'admin') return;
+    
+    try {
+      const response = await axios.get(`${API}/admin/analytics/export`, {
+        params: { dataset, format },
+        responseType: 'blob'
+      });
+      const url = URL.createObjectURL(response.data);
+      const linkElement = document.createElement('a');
+      linkElement.setAttribute('href', url);
+      linkElement.setAttribute('download', `${dataset}-export-${new Date().toISOString().split('T')[0]}.${format}`);
+      linkElement.click();
+      URL.revokeObjectURL(url);
+    } catch (error) {
+      console.error('Error exporting analytics:', error);
+      alert('Fehler beim Exportieren der Daten');
+    }
+  };
+
   // Enhanced Messaging Functions
   const fetchTemplates = async () => {
     setTemplatesLoading(true);
@@ -806,6 +877,8 @@ const Dashboard = () => {
       setEmailDeliveriesOverview(emailDeliveriesRes.data);
       setAllContacts(allContactsRes.data.contacts || []);
       setRecentDeliveries(recentDeliveriesRes.data.deliveries || []);
+      setNextPage('contacts', allContactsRes.data.next_cursor, { limit: 20 });
+      setNextPage('deliveries', recentDeliveriesRes.data.next_cursor, { limit: 20 });
       
     } catch (error) {
       console.error('Error fetching contact management data:', error);
@@ -825,6 +898,7 @@ const Dashboard = () => {
       
       const response = await axios.get(`${API}/admin/contacts/all?${params}`);
       setAllContacts(response.data.contacts || []);
+      setNextPage('contacts', response.data.next_cursor, Object.fromEntries(params));
     } catch (error) {
       console.error('Error searching contacts:', error);
     }
@@ -840,11 +914,65 @@ const Dashboard = () => {
       
       const response = await axios.get(`${API}/admin/email-deliveries/recent?${params}`);
       setRecentDeliveries(response.data.deliveries || []);
+      setNextPage('deliveries', response.data.next_cursor, Object.fromEntries(params));
     } catch (error) {
       console.error('Error filtering deliveries:', error);
     }
   };
 
+  // Load the next page of a paginated list and append it
+  const loadMore = async (list) => {
+    const next = nextPages[list];
+    if (!next || loadingMore) return;
+    
+    const pages = {
+      scheduled: {
+        url: '/messages/scheduled',
+        append: (data) => setMessageTabs(prev => ({
+          ...prev,
+          scheduled: { messages: sortScheduled(appendNew(prev.scheduled.messages, data.messages)), total: data.total }
+        }))
+      },
+      delivered: {
+        url: '/messages/delivered',
+        append: (data) => setMessageTabs(prev => ({
+          ...prev,
+          delivered: { messages: appendNew(prev.delivered.messages, data.messages), total: data.total }
+        }))
+      },
+      transactions: {
+        url: '/admin/transactions',
+        append: (data) => setAdminData(prev => ({ ...prev, transactions: appendNew(prev.transactions, data.transactions || []) }))
+      },
+      payouts: {
+        url: '/admin/payouts',
+        append: (data) => setAdminData(prev => ({ ...prev, payouts: appendNew(prev.payouts, data.payouts || []) }))
+      },
+      contacts: {
+        url: '/admin/contacts/all',
+        append: (data) => setAllContacts(prev => appendNew(prev, data.contacts || []))
+      },
+      deliveries: {
+        url: '/admin/email-deliveries/recent',
+        append: (data) => setRecentDeliveries(prev => appendNew(prev, data.deliveries || []))
+      }
+    };
+    const page = pages[list];
+    
+    setLoadingMore(list);
+    try {
+      const response = await axios.get(`${API}${page.url}`, {
+        params: { ...next.params, cursor: next.cursor }
+      });
+      page.append(response.data);
+      setNextPage(list, response.data.next_cursor, next.params);
+    } catch (error) {
+      console.error(`Error loading more ${list}:`, error);
+    } finally {
+      setLoadingMore(null);
+    }
+  };
+
   const mergeContacts = async (sourceContactId, targetContactId) => {
     if (user?.role !== 'admin') return;
     
@@ -1052,11 +1180,6 @@ const Dashboard = () => {
     });
   };
 
-  // Filter messages by status
-  const getMessagesByStatus = (status) => {
-    return messages.filter(message => message.status === status);
-  };
-
   // Check if message is due soon (within 2 minutes)
   const isMessageDueSoon = (scheduledTime) => {
     const now = new Date();
@@ -1084,18 +1207,107 @@ const Dashboard = () => {
       fetchContactManagementData();
     }
     
-    // Refresh messages every 10 seconds to show delivered messages
-    const interval = setInterval(() => {
-      fetchMessages();
-      if (user?.role === 'admin') {
-        fetchAdminStats();
+  }, [user]);
+
+  // Live updates from the server; every (re)connect gets a fresh short-lived stream token
+  // and resumes after the last event it saw
+  useEffect(() => {
+    if (!user) return;
+    
+    let source = null;
+    let retryTimer = null;
+    let closed = false;
+    let connected = false;
+    let lastEventId = '';
+    const parse = (event) => JSON.parse(event.data);
+    const track = (handler) => (event) => {
+      if (event.lastEventId) lastEventId = event.lastEventId;
+      handler(event);
+    };
+    
+    const connect = async () => {
+      let token;
+      try {
+        token = (await axios.post(`${API}/events/token`)).data.token;
+      } catch (error) {
+        if (!closed) retryTimer = setTimeout(connect, 3000);
+        return;
+      }
+      if (closed) return;
+      
+      const params = new URLSearchParams({ token });
+      if (lastEventId) params.set('last_event_id', lastEventId);
+      source = new EventSource(`${API}/events?${params}`);
+      
+      source.addEventListener('ready', track((event) => {
+        // Reload after a reconnect that could not resume
+        if (connected && !parse(event).resumed) {
+          fetchMessages();
+        }
+        connected = true;
+      }));
+      source.addEventListener('resync', () => fetchMessages());
+      source.addEventListener('message_created', track((event) => {
+        const created = parse(event);
+        setMessageTabs(prev => prev.scheduled.messages.some(message => message.id === created.id) ? prev : {
+          ...prev,
+          scheduled: { messages: sortScheduled([...prev.scheduled.messages, created]), total: prev.scheduled.total + 1 }
+        });
+      }));
+      source.addEventListener('messages_created', track(() => fetchMessages()));
+      source.addEventListener('message_delivered', track((event) => {
+        const update = parse(event);
+        if (!messageTabsRef.current.scheduled.messages.some(message => message.id === update.id)) {
+          // Not loaded yet, so the delivered tab lacks its content
+          fetchMessages();
+          return;
+        }
+        setMessageTabs(prev => {
+          const message = prev.scheduled.messages.find(message => message.id === update.id);
+          if (!message) return prev;
+          const others = prev.scheduled.messages.filter(message => message.id !== update.id);
+          if (update.status !== 'delivered') {
+            // A series stays scheduled with its next occurrence
+            return { ...prev, scheduled: { ...prev.scheduled, messages: sortScheduled([...others, { ...message, ...update }]) } };
+          }
+          return {
+            scheduled: { messages: others, total: prev.scheduled.total - 1 },
+            delivered: { messages: [{ ...message, ...update }, ...prev.delivered.messages], total: prev.delivered.total + 1 }
+          };
+        });
+      }));
+      source.addEventListener('message_deleted', track((event) => {
+        const { id } = parse(event);
+        setMessageTabs(prev => {
+          const next = { ...prev };
+          for (const tab of ['scheduled', 'delivered']) {
+            if (prev[tab].messages.some(message => message.id === id)) {
+              next[tab] = { messages: prev[tab].messages.filter(message => message.id !== id), total: prev[tab].total - 1 };
+            }
+          }
+          return next;
+        });
+      }));
+      if (user.role === 'admin') {
+        source.addEventListener('stats_changed', track(() => fetchAdminStats()));
       }
-    }, 10000);
-    return () => clearInterval(interval);
+      // The stream token has expired by the time the browser would retry, so reconnect here
+      source.onerror = () => {
+        source.close();
+        if (!closed) retryTimer = setTimeout(connect, 3000);
+      };
+    };
+    
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retryTimer);
+      if (source) source.close();
+    };
   }, [user]);
 
-  const scheduledMessages = getMessagesByStatus('scheduled');
-  const deliveredMessages = getMessagesByStatus('delivered');
+  const scheduledMessages = messageTabs.scheduled.messages;
+  const deliveredMessages = messageTabs.delivered.messages;
 
   return (
     <div className="min-h-screen bg-gradient-to-br from-blue-50 to-indigo-100">
@@ -1125,7 +1337,7 @@ const Dashboard = () => {
               }`}
             >
               <Clock className="w-4 h-4 inline mr-2" />
-              {t('nav.scheduled')} ({scheduledMessages.length})
+              {t('nav.scheduled')} ({messageTabs.scheduled.total})
             </button>
             <button
               onClick={() => setActiveTab('delivered')}
@@ -1136,7 +1348,7 @@ const Dashboard = () => {
               }`}
             >
               <CheckCircle className="w-4 h-4 inline mr-2" />
-              {t('nav.delivered')} ({deliveredMessages.length})
+              {t('nav.delivered')} ({messageTabs.delivered.total})
             </button>
             <button
               onClick={() => setActiveTab('subscription')}
@@ -1638,7 +1850,7 @@ const Dashboard = () => {
         {activeTab === 'scheduled' && (
           <div className="bg-white rounded-xl shadow-lg p-6">
             <h2 className="text-2xl font-semibold text-gray-800 mb-6">
-              Geplante Nachrichten ({scheduledMessages.length})
+              Geplante Nachrichten ({messageTabs.scheduled.total})
             </h2>
             {scheduledMessages.length === 0 ? (
               <div className="text-center py-8">
@@ -1707,6 +1919,7 @@ const Dashboard = () => {
                 ))}
               </div>
             )}
+            <LoadMoreButton cursor={nextPages.scheduled} loading={loadingMore === 'scheduled'} onClick={() => loadMore('scheduled')} />
           </div>
         )}
 
@@ -1714,7 +1927,7 @@ const Dashboard = () => {
         {activeTab === 'delivered' && (
           <div className="bg-white rounded-xl shadow-lg p-6">
             <h2 className="text-2xl font-semibold text-gray-800 mb-6">
-              Ausgelieferte Nachrichten ({deliveredMessages.length})
+              Ausgelieferte Nachrichten ({messageTabs.delivered.total})
             </h2>
             {deliveredMessages.length === 0 ? (
               <div className="text-center py-8">
@@ -1763,6 +1976,7 @@ const Dashboard = () => {
                 ))}
               </div>
             )}
+            <LoadMoreButton cursor={nextPages.delivered} loading={loadingMore === 'delivered'} onClick={() => loadMore('delivered')} />
           </div>
         )}
 
@@ -1935,6 +2149,13 @@ const Dashboard = () => {
                       <Download className="w-4 h-4 mr-2" />
                       JSON Export
                     </button>
+                    <button
+                      onClick={() => downloadAnalyticsExport('rollups', 'csv')}
+                      className="px-4 py-2 bg-blue-500 hover:bg-blue-600 text-white text-sm rounded-lg transition-colors flex items-center"
+                    >
+                      <Download className="w-4 h-4 mr-2" />
+                      CSV Export
+                    </button>
                     <button
                       onClick={() => fetchAdvancedAnalytics()}
                       className="px-4 py-2 bg-gray-500 hover:bg-gray-600 text-white text-sm rounded-lg transition-colors flex items-center"
@@ -2564,6 +2785,7 @@ const Dashboard = () => {
                                       </div>
                                     )}
                                   </div>
+                                  <LoadMoreButton cursor={nextPages.contacts} loading={loadingMore === 'contacts'} onClick={() => loadMore('contacts')} />
                                 </div>
                               </div>
                             )}
@@ -2639,6 +2861,7 @@ const Dashboard = () => {
                                       </div>
                                     )}
                                   </div>
+                                  <LoadMoreButton cursor={nextPages.deliveries} loading={loadingMore === 'deliveries'} onClick={() => loadMore('deliveries')} />
                                 </div>
                               </div>
                             )}
@@ -2771,7 +2994,7 @@ const Dashboard = () => {
                       </tr>
                     </thead>
                     <tbody>
-                      {adminData.transactions.slice(0, 10).map((transaction, index) => (
+                      {adminData.transactions.map((transaction, index) => (
                         <tr key={index} className="border-t border-gray-200">
                           <td className="p-3">
                             {new Date(transaction.created_at).toLocaleDateString('de-DE')}
@@ -2805,6 +3028,7 @@ const Dashboard = () => {
                       ))}
                     </tbody>
                   </table>
+                  <LoadMoreButton cursor={nextPages.transactions} loading={loadingMore === 'transactions'} onClick={() => loadMore('transactions')} />
                 </div>
               ) : (
                 <div className="text-center py-8">
@@ -2845,6 +3069,7 @@ const Dashboard = () => {
                       </div>
                     </div>
                   ))}
+                  <LoadMoreButton cursor={nextPages.payouts} loading={loadingMore === 'payouts'} onClick={() => loadMore('payouts')} />
                 </div>
               ) : (
                 <div className="text-center py-8">
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Recurrence rule test, no server or database needed.
+Compares RecurrenceRule.expand (numpy fast path) with RecurrenceRule.occurrences
+(period by period) for random rules, start times and windows.
+"""
+
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+CASES = int(os.environ.get("CASES", "5000"))
+SEED = int(os.environ.get("SEED", "0")) or random.randrange(1 << 30)
+
+def random_rule(rng, weekday_codes):
+    freq = rng.choice(["DAILY", "WEEKLY", "MONTHLY"])
+    parts = [f"FREQ={freq}"]
+    if rng.random() < 0.5:
+        parts.append(f"INTERVAL={rng.randint(2, 5)}")
+    if freq == "WEEKLY" and rng.random() < 0.7:
+        parts.append("BYDAY=" + ",".join(rng.sample(weekday_codes, rng.randint(1, 4))))
+    if rng.random() < 0.5:
+        parts.append(f"WKST={rng.choice(weekday_codes)}")
+    if rng.random() < 0.2:
+        parts.append(f"UNTIL={datetime(2026, 1, 1) + timedelta(days=rng.randint(0, 900)):%Y%m%dT%H%M%S}Z")
+    return ";".join(parts)
+
+def reference(rule, dtstart, after, before, limit, exdates):
+    result = []
+    for occurrence in rule.occurrences(dtstart, after):
+        if before is not None and occurrence >= before:
+            break
+        if occurrence not in exdates:
+            result.append(occurrence)
+            if len(result) >= limit:
+                break
+    return result
+
+def main():
+    sys.path.insert(0, BACKEND_DIR)
+    import server
+
+    rng = random.Random(SEED)
+    print(f"🔁 Comparing expand() with occurrences() for {CASES} random rules (SEED={SEED})")
+    mismatches = 0
+    fast_path = 0
+    for _ in range(CASES):
+        text = random_rule(rng, server.WEEKDAY_CODES)
+        rule = server.RecurrenceRule.parse(text)
+        dtstart = datetime(2026, 1, 1, rng.randint(0, 23), rng.choice([0, 15, 30])) + timedelta(days=rng.randint(0, 60))
+        after = dtstart + timedelta(days=rng.randint(-5, 400), hours=rng.randint(0, 23)) if rng.random() < 0.7 else None
+        before = (after or dtstart) + timedelta(days=rng.randint(1, 200)) if rng.random() < 0.5 else None
+        limit = rng.choice([1, 2, 5, 50])
+        exdates = set(reference(rule, dtstart, after, None, 3, set())[1:2]) if rng.random() < 0.3 else set()
+        fast_path += rule._fast_path_offsets(dtstart) is not None
+
+        expected = reference(rule, dtstart, after, before, limit, exdates)
+        actual = rule.expand(dtstart, after=after, before=before, limit=limit, exdates=exdates)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"❌ {text} dtstart={dtstart} after={after} before={before} limit={limit}")
+                print(f"   expected {expected[:3]}, got {actual[:3]}")
+
+    if mismatches:
+        print(f"❌ {mismatches} of {CASES} rules differ ({fast_path} on the numpy path)")
+        return False
+    print(f"✅ All {CASES} rules match ({fast_path} on the numpy path)")
+    return True
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
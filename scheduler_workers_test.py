@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Multi-worker scheduler test against a local mongod.
+Starts several scheduler worker processes on the same database and verifies:
+- Every due message is delivered exactly once
+- Every recurring series advances exactly one occurrence, in place
+- Partitions are shared between the workers
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+TEST_DB_NAME = f"scheduler_workers_test_{uuid.uuid4().hex[:8]}"
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "4"))
+MESSAGE_COUNT = int(os.environ.get("MESSAGE_COUNT", "5000"))
+RUN_SECONDS = int(os.environ.get("RUN_SECONDS", "20"))
+
+def run_worker(db_name, run_seconds):
+    """Run one scheduler worker process for a fixed time"""
+    os.environ["MONGO_URL"] = MONGO_URL
+    os.environ["DB_NAME"] = db_name
+    os.environ["SCHEDULER_LEASE_RENEW_SECONDS"] = "1"
+    os.environ["SCHEDULER_LEASE_SECONDS"] = "3"
+    sys.path.insert(0, BACKEND_DIR)
+    import server
+
+    async def main():
+        task = asyncio.create_task(server.message_scheduler())
+        await asyncio.sleep(run_seconds)
+        server.scheduler_running = False
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await server.lease_manager.release_all()
+        print(f"   Worker {server.WORKER_ID}: {server.scheduler_metrics['delivered_total']} delivered, "
+              f"{server.scheduler_metrics['claim_conflicts']} claim conflicts")
+
+    asyncio.run(main())
+
+async def seed_messages(db, count):
+    """Insert due messages for many users, half of them recurring"""
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ["DB_NAME"] = TEST_DB_NAME
+    import server
+
+    await server.ensure_indexes()
+    now = datetime.utcnow()
+    messages = [
+        server.ScheduledMessage(
+            user_id=f"user-{i % 500}",
+            title=f"Worker Test {i}",
+            content="Multi-worker delivery test",
+            scheduled_time=now + timedelta(seconds=(i % 10)),
+            is_recurring=(i % 2 == 0),
+            recurring_pattern="daily" if i % 2 == 0 else None
+        ).dict()
+        for i in range(count)
+    ]
+    await db.scheduled_messages.insert_many(messages)
+    return [m["id"] for m in messages], sum(1 for m in messages if m["is_recurring"])
+
+async def verify(db, message_ids, recurring_count):
+    delivered = await db.scheduled_messages.count_documents({"id": {"$in": message_ids}, "occurrences_delivered": 1})
+    leftover = await db.scheduled_messages.count_documents({"id": {"$in": message_ids}, "occurrences_delivered": {"$ne": 1}})
+    advanced = await db.scheduled_messages.count_documents({"id": {"$in": message_ids}, "status": "scheduled", "recurrence_rule": "FREQ=DAILY"})
+    extra_documents = await db.scheduled_messages.count_documents({"id": {"$nin": message_ids}})
+    leases = await db.scheduler_leases.distinct("owner")
+    return delivered, leftover, advanced, extra_documents, leases
+
+def main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    print(f"🔗 Testing {WORKER_COUNT} scheduler workers against {MONGO_URL}/{TEST_DB_NAME}")
+    client = AsyncIOMotorClient(MONGO_URL)
+    db = client[TEST_DB_NAME]
+    loop = asyncio.new_event_loop()
+
+    try:
+        message_ids, recurring_count = loop.run_until_complete(seed_messages(db, MESSAGE_COUNT))
+        print(f"✅ Seeded {len(message_ids)} messages ({recurring_count} recurring)")
+
+        started = time.time()
+        # Spawn fresh interpreters so no worker shares the parent's MongoDB client
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=run_worker, args=(TEST_DB_NAME, RUN_SECONDS)) for _ in range(WORKER_COUNT)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        print(f"✅ Workers finished after {time.time() - started:.1f}s")
+
+        delivered, leftover, advanced, extra_documents, leases = loop.run_until_complete(verify(db, message_ids, recurring_count))
+        success = True
+
+        if delivered == len(message_ids) and leftover == 0:
+            print(f"✅ All {delivered} messages delivered exactly once")
+        else:
+            print(f"❌ {delivered} delivered, {leftover} not delivered")
+            success = False
+
+        if advanced == recurring_count and extra_documents == 0:
+            print(f"✅ {advanced} recurring series advanced in place, no extra documents")
+        else:
+            print(f"❌ Expected {recurring_count} advanced series, found {advanced} and {extra_documents} extra documents")
+            success = False
+
+        print(f"   Lease owners after shutdown: {leases}")
+        return success
+    finally:
+        loop.run_until_complete(client.drop_database(TEST_DB_NAME))
+        client.close()
+        loop.close()
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)